@@ -1,28 +1,147 @@
+import asyncio
+import hashlib
+import logging
 import httpx
-from typing import Dict, Any, Optional
+import orjson
+from cachetools import TTLCache
+from typing import AsyncIterator, Dict, Any, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+class StreamIncompleteError(Exception):
+    """
+    Raised when a streamed chat completion fails or ends before the server signals completion.
+    """
+
+
+# Result handed to coalesced waiters when the request they joined was cancelled
+_LEADER_CANCELLED = object()
+
+# HTTP clients shared between OpenAIClient instances with identical connection settings.
+# httpx pools connections per host, so endpoints on the same host reuse the same connections.
+_shared_clients: Dict[Tuple[Any, ...], httpx.AsyncClient] = {}
+_shared_client_refs: Dict[Tuple[Any, ...], int] = {}
+
+
+def _acquire_shared_client(settings: Tuple[Any, ...]) -> httpx.AsyncClient:
+    """
+    Get the shared HTTP client for the given connection settings, creating it if needed.
+
+    Args:
+        settings: (max_connections, max_keepalive_connections, keepalive_expiry,
+            connect_timeout, read_timeout, write_timeout, pool_timeout, http2)
+
+    Returns:
+        The shared httpx.AsyncClient
+    """
+    client = _shared_clients.get(settings)
+    if client is None:
+        (max_connections, max_keepalive_connections, keepalive_expiry,
+         connect_timeout, read_timeout, write_timeout, pool_timeout, http2) = settings
+        client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive_connections,
+                keepalive_expiry=keepalive_expiry,
+            ),
+            timeout=httpx.Timeout(
+                connect=connect_timeout,
+                read=read_timeout,
+                write=write_timeout,
+                pool=pool_timeout,
+            ),
+            http2=http2,
+        )
+        _shared_clients[settings] = client
+    _shared_client_refs[settings] = _shared_client_refs.get(settings, 0) + 1
+    return client
+
+
+async def _release_shared_client(settings: Tuple[Any, ...]) -> None:
+    """
+    Release a reference to a shared HTTP client, closing it when no longer used.
+
+    Args:
+        settings: The connection settings the client was acquired with
+    """
+    refs = _shared_client_refs.get(settings, 0) - 1
+    if refs > 0:
+        _shared_client_refs[settings] = refs
+        return
+
+    _shared_client_refs.pop(settings, None)
+    client = _shared_clients.pop(settings, None)
+    if client is not None:
+        await client.aclose()
 
 class OpenAIClient:
     """
     Client for interacting with OpenAI-compatible APIs.
     """
 
-    def __init__(self, api_key: str, base_url: str):
+    def __init__(
+        self,
+        api_key: str,
+        base_url: str,
+        max_connections: int = 200,
+        max_keepalive_connections: int = 50,
+        keepalive_expiry: float = 60.0,
+        connect_timeout: float = 5.0,
+        read_timeout: float = 120.0,
+        write_timeout: float = 10.0,
+        pool_timeout: float = 5.0,
+        http2: bool = True,
+        stream: bool = False,
+        cache_ttl: float = 0,
+        cache_maxsize: int = 2048,
+        max_concurrency: int = 16,
+    ):
         """
         Initialize the OpenAI client.
 
         Args:
             api_key: The API key for authentication.
             base_url: The base URL of the OpenAI-compatible API endpoint.
+            max_connections: Maximum number of concurrent connections in the pool.
+            max_keepalive_connections: Maximum number of idle connections kept alive.
+            keepalive_expiry: Seconds an idle keep-alive connection is retained.
+            connect_timeout: Timeout (seconds) for establishing a connection.
+            read_timeout: Timeout (seconds) for reading the response.
+            write_timeout: Timeout (seconds) for sending the request body.
+            pool_timeout: Timeout (seconds) for acquiring a connection from the pool.
+            http2: Whether to enable HTTP/2 (requires the `h2` package).
+            stream: Whether replies from this endpoint should be streamed (requires server-sent events support).
+                Streamed requests are not coalesced with identical in-flight requests.
+            cache_ttl: Seconds to cache responses to identical requests (0 disables caching).
+            cache_maxsize: Maximum number of cached responses.
+            max_concurrency: Maximum number of requests in flight to this endpoint; extra requests wait their turn.
         """
         self.api_key = api_key
         self.base_url = base_url.rstrip('/')  # Ensure no trailing slash
-        self.client = httpx.AsyncClient(
-            base_url=self.base_url,
-            headers={
-                "Authorization": f"Bearer {self.api_key}",
-                "Content-Type": "application/json"
-            }
+        self.stream = stream
+        self._headers = {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json"
+        }
+        self._chat_completions_url = f"{self.base_url}/chat/completions"
+        self._client_settings = (
+            max_connections, max_keepalive_connections, keepalive_expiry,
+            connect_timeout, read_timeout, write_timeout, pool_timeout, http2,
         )
+        self.client = _acquire_shared_client(self._client_settings)
+        # Bounds concurrent upstream requests so bursts queue here instead of hitting provider rate limits
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        # In-flight requests keyed by payload hash, so identical concurrent calls share one upstream request
+        self._inflight: Dict[str, asyncio.Future] = {}
+        # Completed responses keyed by payload hash, for endpoints that opt in via cache_ttl
+        self._cache: Optional[TTLCache] = TTLCache(maxsize=cache_maxsize, ttl=cache_ttl) if cache_ttl > 0 else None
+
+    @staticmethod
+    def _request_key(payload: Dict[str, Any]) -> str:
+        """
+        Compute a stable hash identifying a request payload.
+        """
+        return hashlib.blake2b(orjson.dumps(payload, option=orjson.OPT_SORT_KEYS)).hexdigest()
 
     async def create_chat_completion(self, model: str, messages: list, **kwargs) -> Optional[Dict[str, Any]]:
         """
@@ -36,27 +155,150 @@ class OpenAIClient:
         Returns:
             The API response dictionary or None if an error occurred.
         """
-        payload = {
-            "model": model,
-            "messages": messages,
-            **kwargs
-        }
+        return await self.post_chat({"model": model, **kwargs}, messages)
+
+    async def post_chat(self, payload_template: Dict[str, Any], messages: list) -> Optional[Dict[str, Any]]:
+        """
+        Create a chat completion from a pre-built request body.
+
+        Args:
+            payload_template: Request body without messages (model and parameters), typically precomputed per command.
+            messages: A list of message objects (e.g., [{"role": "user", "content": "Hello"}]).
+
+        Returns:
+            The API response dictionary or None if an error occurred.
+        """
+        payload = {**payload_template, "messages": messages}
+        key = self._request_key(payload)
+
+        if self._cache is not None:
+            cached = self._cache.get(key)
+            if cached is not None:
+                return cached
+
+        while True:
+            inflight = self._inflight.get(key)
+            if inflight is None:
+                break
+            # An identical request is already in flight; wait for its result instead of sending another
+            result = await asyncio.shield(inflight)
+            if result is not _LEADER_CANCELLED:
+                return result
+            # The request we were waiting on was cancelled; send (or join) a fresh one
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            result = await self._post_chat_completion(payload)
+        except asyncio.CancelledError:
+            # Only this caller was cancelled; let any waiters retry on their own
+            future.set_result(_LEADER_CANCELLED)
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # Mark as retrieved so it is not reported when nobody else is waiting
+            raise
+        else:
+            future.set_result(result)
+            if self._cache is not None and result is not None:
+                self._cache[key] = result
+            return result
+        finally:
+            self._inflight.pop(key, None)
+
+    async def _post_chat_completion(self, payload: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """
+        Send a chat completion request to the API.
+
+        Args:
+            payload: The full request body.
+
+        Returns:
+            The API response dictionary or None if an error occurred.
+        """
         try:
-            response = await self.client.post("/chat/completions", json=payload)
+            async with self._semaphore:
+                response = await self.client.post(self._chat_completions_url, content=orjson.dumps(payload), headers=self._headers)
             response.raise_for_status()  # Raise an exception for bad status codes (4xx or 5xx)
-            return response.json()
+            return orjson.loads(response.content)
         except httpx.RequestError as e:
-            print(f"An error occurred while requesting {e.request.url!r}: {e}")
+            logger.warning("OpenAI request to %s failed: %s", e.request.url, e)
             return None
         except httpx.HTTPStatusError as e:
-            print(f"Error response {e.response.status_code} while requesting {e.request.url!r}: {e.response.text}")
+            logger.warning("OpenAI HTTP %s from %s: %s", e.response.status_code, e.request.url, e.response.text)
             return None
         except Exception as e:
-            print(f"An unexpected error occurred: {e}")
+            logger.warning("Unexpected error during OpenAI request: %s", e, exc_info=e)
             return None
 
+    async def post_chat_stream(self, payload_template: Dict[str, Any], messages: list) -> AsyncIterator[str]:
+        """
+        Create a streamed chat completion from a pre-built request body.
+
+        Args:
+            payload_template: Request body without messages (model and parameters), typically precomputed per command.
+            messages: A list of message objects (e.g., [{"role": "user", "content": "Hello"}]).
+
+        Yields:
+            Pieces of the assistant's reply.
+
+        Raises:
+            StreamIncompleteError: If the request fails or the stream ends before [DONE]; the pieces
+                yielded so far are then only part of the reply.
+        """
+        payload = {**payload_template, "messages": messages}
+        key = self._request_key(payload) if self._cache is not None else None
+        if key is not None:
+            cached = self._cache.get(key)
+            if cached is not None:
+                yield cached["choices"][0]["message"]["content"]
+                return
+
+        payload["stream"] = True
+        parts: List[str] = []
+        done = False  # Set once the server signals the end of the stream
+        try:
+            async with self._semaphore, self.client.stream("POST", self._chat_completions_url, content=orjson.dumps(payload), headers=self._headers) as response:
+                if response.is_error:
+                    await response.aread()  # Load the error body so it can be logged
+                    response.raise_for_status()
+
+                async for line in response.aiter_lines():
+                    # Server-sent events: only "data:" lines carry chunks
+                    if not line.startswith("data:"):
+                        continue
+                    data = line[5:].strip()
+                    if data == "[DONE]":
+                        done = True
+                        break
+
+                    choices = orjson.loads(data).get("choices")
+                    if choices:
+                        content = (choices[0].get("delta") or {}).get("content")
+                        if content:
+                            parts.append(content)
+                            yield content
+
+        except httpx.RequestError as e:
+            logger.warning("OpenAI request to %s failed: %s", e.request.url, e)
+            raise StreamIncompleteError(str(e)) from e
+        except httpx.HTTPStatusError as e:
+            logger.warning("OpenAI HTTP %s from %s: %s", e.response.status_code, e.request.url, e.response.text)
+            raise StreamIncompleteError(str(e)) from e
+        except Exception as e:
+            logger.warning("Unexpected error during OpenAI request: %s", e, exc_info=e)
+            raise StreamIncompleteError(str(e)) from e
+
+        if not done:
+            logger.warning("OpenAI stream from %s ended before [DONE]", self._chat_completions_url)
+            raise StreamIncompleteError("Stream ended before [DONE]")
+
+        if key is not None and parts:
+            # Cache in the same shape as a non-streamed response
+            self._cache[key] = {"choices": [{"message": {"role": "assistant", "content": "".join(parts)}}]}
+
     async def close(self):
         """
-        Close the HTTP client.
+        Release the shared HTTP client, closing it once no other endpoint uses it.
         """
-        await self.client.aclose()
+        await _release_shared_client(self._client_settings)
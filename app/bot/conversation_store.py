@@ -0,0 +1,153 @@
+"""
+Conversation storage backends for per-user chat sessions.
+"""
+import os
+import logging
+import orjson
+from collections import deque
+from cachetools import TTLCache
+from typing import Dict, Any, Optional
+
+logger = logging.getLogger(__name__)
+
+# 每个用户保留的最大历史消息数
+MAX_HISTORY_MESSAGES = 20
+
+# 会话在无活动后保留的秒数
+SESSION_TTL = 3600
+
+
+def new_session(endpoint_name: str, payload_template: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Create an empty conversation session.
+
+    Args:
+        endpoint_name: The API endpoint used by the session.
+        payload_template: Request body without messages (model and parameters) used by the session.
+
+    Returns:
+        A session dictionary with an empty, bounded message history.
+    """
+    return {
+        "current_endpoint": endpoint_name,
+        "current_payload_template": payload_template,
+        "messages": deque(maxlen=MAX_HISTORY_MESSAGES)
+    }
+
+
+class MemoryConversationStore:
+    """
+    In-process conversation store. Sessions are lost on restart and not shared between workers.
+    """
+
+    def __init__(self, maxsize: int = 10_000, ttl: int = SESSION_TTL):
+        """
+        Initialize the in-memory store.
+
+        Args:
+            maxsize: Maximum number of sessions kept in memory.
+            ttl: Seconds after which an untouched session expires.
+        """
+        self._sessions: TTLCache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    async def get(self, user_id: int) -> Optional[Dict[str, Any]]:
+        """
+        Get a user's session.
+
+        Args:
+            user_id: Telegram user ID
+
+        Returns:
+            The session dictionary or None if the user has no active session
+        """
+        return self._sessions.get(user_id)
+
+    async def set(self, user_id: int, session: Dict[str, Any]) -> None:
+        """
+        Store a user's session and refresh its expiry.
+
+        Args:
+            user_id: Telegram user ID
+            session: The session dictionary
+        """
+        self._sessions[user_id] = session
+
+    async def close(self) -> None:
+        """
+        Release resources held by the store.
+        """
+        self._sessions.clear()
+
+
+class RedisConversationStore:
+    """
+    Redis-backed conversation store, shared by all webhook workers and persistent across restarts.
+    """
+
+    def __init__(self, url: str, ttl: int = SESSION_TTL, max_connections: int = 64):
+        """
+        Initialize the Redis store.
+
+        Args:
+            url: Redis connection URL (e.g. redis://localhost:6379/0).
+            ttl: Seconds after which an untouched session expires.
+            max_connections: Maximum number of pooled Redis connections.
+        """
+        from redis.asyncio import ConnectionPool, Redis
+
+        self.ttl = ttl
+        self.redis = Redis.from_pool(ConnectionPool.from_url(url, max_connections=max_connections))
+
+    @staticmethod
+    def _key(user_id: int) -> str:
+        return f"conv:{user_id}"
+
+    async def get(self, user_id: int) -> Optional[Dict[str, Any]]:
+        """
+        Get a user's session.
+
+        Args:
+            user_id: Telegram user ID
+
+        Returns:
+            The session dictionary or None if the user has no active session
+        """
+        raw = await self.redis.get(self._key(user_id))
+        if not raw:
+            return None
+
+        session = orjson.loads(raw)
+        session["messages"] = deque(session.get("messages", []), maxlen=MAX_HISTORY_MESSAGES)
+        return session
+
+    async def set(self, user_id: int, session: Dict[str, Any]) -> None:
+        """
+        Store a user's session and refresh its expiry.
+
+        Args:
+            user_id: Telegram user ID
+            session: The session dictionary
+        """
+        data = {**session, "messages": list(session["messages"])[-MAX_HISTORY_MESSAGES:]}
+        await self.redis.set(self._key(user_id), orjson.dumps(data), ex=self.ttl)
+
+    async def close(self) -> None:
+        """
+        Close the Redis connection pool.
+        """
+        await self.redis.aclose()
+
+
+def create_conversation_store():
+    """
+    Create the conversation store configured by the environment.
+
+    Uses Redis when REDIS_URL is set, otherwise falls back to an in-memory store.
+    """
+    redis_url = os.environ.get("REDIS_URL")
+    if redis_url:
+        logger.info("Using Redis conversation store")
+        return RedisConversationStore(redis_url)
+
+    logger.info("REDIS_URL not set, using in-memory conversation store")
+    return MemoryConversationStore()
@@ -0,0 +1,110 @@
+"""
+Lightweight stand-ins for python-telegram-bot objects, used to handle plain text messages
+without building the full Update object graph.
+"""
+from typing import Any, Dict, Optional
+from telegram import Bot, Message, ReplyParameters
+
+
+class FastUser:
+    """
+    Minimal replacement for telegram.User, exposing only the user ID.
+    """
+    __slots__ = ("id",)
+
+    def __init__(self, user_id: int):
+        self.id = user_id
+
+
+class FastChat:
+    """
+    Minimal replacement for telegram.Chat, exposing the chat ID and type.
+    """
+    __slots__ = ("id", "type")
+
+    def __init__(self, chat_id: int, chat_type: str):
+        self.id = chat_id
+        self.type = chat_type
+
+
+class FastMessage:
+    """
+    Minimal replacement for telegram.Message supporting the text and reply_text() used by handlers.
+    """
+    __slots__ = ("bot", "message_id", "chat", "text")
+
+    def __init__(self, bot: Bot, message_id: int, chat: FastChat, text: str):
+        self.bot = bot
+        self.message_id = message_id
+        self.chat = chat
+        self.text = text
+
+    async def reply_text(self, text: str) -> Message:
+        """
+        Send a reply to this message's chat.
+
+        Like telegram.Message.reply_text, the original message is only quoted outside private chats.
+
+        Args:
+            text: The text to send
+
+        Returns:
+            The sent telegram.Message
+        """
+        reply_parameters = ReplyParameters(self.message_id) if self.chat.type != "private" else None
+        return await self.bot.send_message(chat_id=self.chat.id, text=text, reply_parameters=reply_parameters)
+
+
+class FastTextUpdate:
+    """
+    Minimal replacement for telegram.Update carrying a plain text message.
+    """
+    __slots__ = ("update_id", "message", "effective_user", "effective_chat", "command")
+
+    def __init__(self, update_id: int, message: FastMessage, user: FastUser, command: Optional[str]):
+        self.update_id = update_id
+        self.message = message
+        self.effective_user = user
+        self.effective_chat = message.chat
+        self.command = command
+
+
+class FastContext:
+    """
+    Minimal replacement for the handler context, exposing only the bot.
+    """
+    __slots__ = ("bot",)
+
+    def __init__(self, bot: Bot):
+        self.bot = bot
+
+
+def parse_text_update(data: Dict[str, Any], bot: Bot) -> Optional[FastTextUpdate]:
+    """
+    Build a FastTextUpdate from raw update data if it is a plain text message.
+
+    Args:
+        data: The decoded webhook payload
+        bot: The bot used to send replies
+
+    Returns:
+        A FastTextUpdate, or None if the update needs the full python-telegram-bot handling
+    """
+    message = data.get("message")
+    if not message or "text" not in message or "from" not in message or message.get("is_topic_message"):
+        return None
+
+    text = message["text"]
+    command = None
+    entities = message.get("entities")
+    # Same rule as filters.COMMAND: a bot_command entity at the very start of the text
+    if entities and entities[0].get("type") == "bot_command" and entities[0].get("offset") == 0:
+        command = text[1:entities[0]["length"]].lower()
+
+    chat = FastChat(message["chat"]["id"], message["chat"].get("type", "private"))
+    return FastTextUpdate(
+        update_id=data["update_id"],
+        message=FastMessage(bot, message["message_id"], chat, text),
+        user=FastUser(message["from"]["id"]),
+        command=command,
+    )
@@ -1,10 +1,18 @@
 import os
+import asyncio
 import logging
+import weakref
+from collections import deque
+from contextlib import aclosing
+from datetime import timedelta
 from telegram import Update, BotCommand
+from telegram.error import BadRequest, RetryAfter
 from telegram.ext import Application, CommandHandler, MessageHandler, ContextTypes, filters, ConversationHandler
-from app.config.config_loader import ConfigLoader
-from app.api.client import OpenAIClient
-from typing import Dict, Any, List
+from app.config.config_loader import CommandSpec, get_config_loader
+from app.api.client import OpenAIClient, StreamIncompleteError
+from app.bot.conversation_store import MAX_HISTORY_MESSAGES, create_conversation_store, new_session
+from app.bot.fast_update import FastContext, parse_text_update
+from typing import Callable, Dict, Any, List, Optional, Tuple
 
 # Configure logging
 logging.basicConfig(
@@ -16,13 +24,35 @@ logger = logging.getLogger(__name__)
 # Global cache for OpenAI clients (one per API endpoint config)
 api_clients: Dict[str, OpenAIClient] = {}
 
-# Global config loader instance
-config_loader = ConfigLoader()
+# Telegram 单条消息的最大长度
+TELEGRAM_MAX_MESSAGE_LENGTH = 4096
 
-# 全局变量用于存储用户会话历史
-user_conversations: Dict[int, Dict[str, Any]] = {}
+# 流式回复时两次编辑消息之间的最小间隔（秒）
+STREAM_EDIT_INTERVAL = 0.5
 
-async def is_user_authorized(user_id: int) -> bool:
+# 用户会话历史存储（设置 REDIS_URL 时使用 Redis，否则保存在内存中）
+conversation_store = create_conversation_store()
+
+# 每个用户的锁，保证同一用户的请求按顺序处理，避免并发修改同一会话历史
+user_locks: "weakref.WeakValueDictionary[int, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+def get_user_lock(user_id: int) -> asyncio.Lock:
+    """
+    获取用户对应的锁，不存在时创建。
+
+    Args:
+        user_id: Telegram用户ID
+
+    Returns:
+        该用户的asyncio.Lock
+    """
+    lock = user_locks.get(user_id)
+    if lock is None:
+        lock = asyncio.Lock()
+        user_locks[user_id] = lock
+    return lock
+
+def is_user_authorized(user_id: int) -> bool:
     """
     检查用户是否在授权列表中。
 
@@ -32,13 +62,16 @@ async def is_user_authorized(user_id: int) -> bool:
     Returns:
         如果用户已授权则返回True，否则返回False
     """
-    authorized_users = config_loader.get_authorized_users()
-    return user_id in authorized_users or len(authorized_users) == 0  # 如果列表为空，则允许所有用户
+    authorized_users = get_config_loader().get_authorized_users()
+    return not authorized_users or user_id in authorized_users  # 如果列表为空，则允许所有用户
 
-async def get_openai_client(endpoint_name: str) -> OpenAIClient:
+def get_openai_client(endpoint_name: str) -> OpenAIClient:
     """
     Get or create an OpenAIClient instance for a given endpoint configuration.
 
+    This is a plain function: the cache hit is a single dict lookup, and creating a client
+    never awaits, so concurrent handlers cannot interleave and create duplicate clients.
+
     Args:
         endpoint_name: The name of the API endpoint configuration.
 
@@ -51,7 +84,7 @@ async def get_openai_client(endpoint_name: str) -> OpenAIClient:
     if endpoint_name in api_clients:
         return api_clients[endpoint_name]
 
-    endpoint_config = config_loader.get_api_endpoint(endpoint_name)
+    endpoint_config = get_config_loader().get_api_endpoint(endpoint_name)
     if not endpoint_config:
         raise ValueError(f"API endpoint configuration '{endpoint_name}' not found.")
 
@@ -61,32 +94,166 @@ async def get_openai_client(endpoint_name: str) -> OpenAIClient:
     if not api_key or not base_url:
         raise ValueError(f"Invalid configuration for endpoint '{endpoint_name}': missing api_key or base_url.")
 
-    client = OpenAIClient(api_key=api_key, base_url=base_url)
+    # 可选的连接池/超时配置，未设置时使用 OpenAIClient 的默认值
+    client_options = {
+        key: endpoint_config[key]
+        for key in (
+            "max_connections",
+            "max_keepalive_connections",
+            "keepalive_expiry",
+            "connect_timeout",
+            "read_timeout",
+            "write_timeout",
+            "pool_timeout",
+            "http2",
+            "stream",
+            "cache_ttl",
+            "cache_maxsize",
+            "max_concurrency",
+        )
+        if key in endpoint_config
+    }
+
+    client = OpenAIClient(api_key=api_key, base_url=base_url, **client_options)
     api_clients[endpoint_name] = client
     logger.info(f"Initialized OpenAIClient for endpoint: {endpoint_name}")
     return client
 
-def command_handler_factory(command_config: Dict[str, Any]):
+async def stream_reply(update: Update, client: OpenAIClient, payload_template: Dict[str, Any], messages: list) -> str:
+    """
+    流式获取AI回复，并定期编辑Telegram消息以逐步显示内容。
+
+    Args:
+        update: 触发回复的Telegram更新
+        client: 使用的OpenAIClient
+        payload_template: 不含消息的请求体（模型和参数）
+        messages: 发送给API的消息列表
+
+    Returns:
+        完整的回复文本，未收到任何内容时返回空字符串
+
+    Raises:
+        StreamIncompleteError: 回复未完整接收时抛出（已显示的部分内容保留在消息中）
+    """
+    loop = asyncio.get_running_loop()
+    reply_text = ""
+    message = None       # 当前正在编辑的Telegram消息
+    shown_text = ""      # 当前消息中已显示的文本
+    segment_start = 0    # 当前消息在完整回复中的起始位置
+    next_flush = 0.0     # 下一次允许更新消息的时间
+
+    async def show(text: str):
+        # Telegram会去掉消息首尾的空白，因此按去掉尾部空白后的文本比较，纯空白内容不发送
+        nonlocal message, shown_text
+        text = text.rstrip()
+        if not text or text == shown_text:
+            return
+        if message is None:
+            message = await update.message.reply_text(text)
+        else:
+            try:
+                await message.edit_text(text)
+            except BadRequest as e:
+                # 内容与当前消息相同，视为已更新
+                if "message is not modified" not in str(e).lower():
+                    raise
+        shown_text = text
+
+    async def send_pending():
+        nonlocal message, shown_text, segment_start
+        segment = reply_text[segment_start:]
+        # 超出Telegram单条消息长度时，补全当前消息并开始新消息
+        while len(segment) > TELEGRAM_MAX_MESSAGE_LENGTH:
+            await show(segment[:TELEGRAM_MAX_MESSAGE_LENGTH])
+            message, shown_text = None, ""
+            segment_start += TELEGRAM_MAX_MESSAGE_LENGTH
+            segment = reply_text[segment_start:]
+
+        await show(segment)
+
+    async def flush(final: bool = False):
+        nonlocal next_flush
+        while True:
+            try:
+                await send_pending()
+                next_flush = loop.time() + STREAM_EDIT_INTERVAL
+                return
+            except RetryAfter as e:
+                retry_after = e.retry_after
+                delay = retry_after.total_seconds() if isinstance(retry_after, timedelta) else float(retry_after)
+                logger.warning(f"Telegram flood control while streaming reply, retrying in {delay}s")
+                if not final:
+                    # 中间更新直接跳过，等限流结束后再更新
+                    next_flush = loop.time() + delay
+                    return
+                await asyncio.sleep(delay)
+
+    # 发送消息出错时立即关闭流，释放并发名额和HTTP连接
+    async with aclosing(client.post_chat_stream(payload_template, messages)) as stream:
+        async for content in stream:
+            reply_text += content
+            if loop.time() >= next_flush:
+                await flush()
+
+    await flush(final=True)
+    return reply_text
+
+async def generate_reply(update: Update, client: OpenAIClient, endpoint_name: str, payload_template: Dict[str, Any], messages: list) -> Optional[str]:
+    """
+    调用API生成回复并发送给用户。
+
+    Args:
+        update: 触发回复的Telegram更新
+        client: 使用的OpenAIClient
+        endpoint_name: API端点名称（用于日志）
+        payload_template: 不含消息的请求体（模型和参数）
+        messages: 发送给API的消息列表
+
+    Returns:
+        已发送的回复文本，API未返回有效回复时返回None
+    """
+    if client.stream:
+        try:
+            reply_text = await stream_reply(update, client, payload_template, messages)
+        except StreamIncompleteError as e:
+            # 不完整的回复不计入会话历史
+            logger.error(f"Incomplete streamed response from API for endpoint {endpoint_name}: {e}")
+            return None
+        if reply_text:
+            return reply_text
+        logger.error(f"Empty streamed response from API for endpoint {endpoint_name}")
+        return None
+
+    response = await client.post_chat(payload_template, messages)
+
+    if response and response.get("choices"):
+        assistant_message = response["choices"][0].get("message", {})
+        reply_text = assistant_message.get("content", "抱歉，我无法获取回复。")
+        await update.message.reply_text(reply_text)
+        return reply_text
+
+    logger.error(f"Invalid or empty response from API for endpoint {endpoint_name}: {response}")
+    return None
+
+async def config_error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Handler registered for commands whose configuration is invalid.
+    """
+    logger.error(f"Command configuration error for command triggered by user {update.effective_user.id}")
+    await update.message.reply_text("抱歉，此命令的配置存在错误。")
+
+def command_handler_factory(command_config: CommandSpec):
     """
     Factory function to create command handlers based on configuration.
 
     Args:
-        command_config: Configuration dictionary for the command.
+        command_config: Pre-resolved CommandSpec for the command.
 
     Returns:
         An asynchronous function that acts as the command handler.
     """
-    endpoint_name = command_config.get("api_endpoint")
-    model = command_config.get("model")
-    params = command_config.get("parameters", {})
-
-    if not endpoint_name or not model:
-        logger.error(f"Invalid command config: {command_config}. Missing 'api_endpoint' or 'model'.")
-        # Return a dummy handler that logs an error
-        async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-            logger.error(f"Command configuration error for command triggered by user {update.effective_user.id}")
-            await update.message.reply_text("抱歉，此命令的配置存在错误。")
-        return error_handler
+    endpoint_name = command_config.endpoint
+    payload_template = command_config.payload_template # 包含模型和配置的参数，如temperature, max_tokens
 
     async def handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handles the command dynamically based on config."""
@@ -94,7 +261,7 @@ def command_handler_factory(command_config: Dict[str, Any]):
         chat_id = update.effective_chat.id
 
         # 检查用户是否已授权
-        if not await is_user_authorized(user_id):
+        if not is_user_authorized(user_id):
             logger.warning(f"Unauthorized user {user_id} attempted to use the bot")
             await update.message.reply_text("抱歉，您没有权限使用此机器人。")
             return
@@ -107,69 +274,43 @@ def command_handler_factory(command_config: Dict[str, Any]):
         logger.info(f"Handling command for user {user_id} with config: {command_config}")
 
         try:
-            client = await get_openai_client(endpoint_name)
+            client = get_openai_client(endpoint_name)
         except ValueError as e:
             logger.error(f"Failed to get OpenAI client: {e}")
             await update.message.reply_text("抱歉，API连接配置出错。")
             return
 
-        # 初始化或获取用户的对话历史
-        if user_id not in user_conversations:
-            user_conversations[user_id] = {
-                "current_endpoint": endpoint_name,
-                "current_model": model,
-                "current_params": params,
-                "messages": []
-            }
-        else:
-            # 更新当前会话的模型和端点
-            user_conversations[user_id]["current_endpoint"] = endpoint_name
-            user_conversations[user_id]["current_model"] = model
-            user_conversations[user_id]["current_params"] = params
-            # 如果用户使用新命令，则清除历史会话
-            user_conversations[user_id]["messages"] = []
+        async with get_user_lock(user_id):
+            # 使用新命令时开始一个新的会话，清除之前的历史
+            session = new_session(endpoint_name, payload_template)
+            messages = session["messages"]
 
-        # 添加用户消息到会话历史
-        if user_content:
-            user_conversations[user_id]["messages"].append({"role": "user", "content": user_content})
+            # 添加用户消息到会话历史
+            if user_content:
+                messages.append({"role": "user", "content": user_content})
 
-        # 使用对话历史构建消息
-        messages = user_conversations[user_id]["messages"]
+            # 如果没有消息或消息为空，添加一个默认的用户消息
+            if not messages or (len(messages) == 1 and not messages[0].get("content")):
+                messages = deque([{"role": "user", "content": "你好，请介绍一下你自己。"}], maxlen=MAX_HISTORY_MESSAGES)
+                session["messages"] = messages
 
-        # 如果没有消息或消息为空，添加一个默认的用户消息
-        if not messages or (len(messages) == 1 and not messages[0].get("content")):
-            messages = [{"role": "user", "content": "你好，请介绍一下你自己。"}]
-            user_conversations[user_id]["messages"] = messages
+            try:
+                # 显示输入指示器
+                await context.bot.send_chat_action(chat_id=chat_id, action='typing')
 
-        try:
-            # 显示输入指示器
-            await context.bot.send_chat_action(chat_id=chat_id, action='typing')
+                reply_text = await generate_reply(update, client, endpoint_name, payload_template, list(messages))
 
-            response = await client.create_chat_completion(
-                model=model,
-                messages=messages,
-                **params # 传递配置的参数，如temperature, max_tokens
-            )
-
-            if response and response.get("choices"):
-                assistant_message = response["choices"][0].get("message", {})
-                reply_text = assistant_message.get("content", "抱歉，我无法获取回复。")
-
-                # 添加助手回复到会话历史
-                user_conversations[user_id]["messages"].append({"role": "assistant", "content": reply_text})
+                if reply_text is not None:
+                    # 添加助手回复到会话历史
+                    messages.append({"role": "assistant", "content": reply_text})
+                else:
+                    await update.message.reply_text("抱歉，我从AI服务收到了意外的响应。")
 
-                # 限制会话历史的长度，防止过长
-                if len(user_conversations[user_id]["messages"]) > 20:  # 保留最近的20条消息
-                    user_conversations[user_id]["messages"] = user_conversations[user_id]["messages"][-20:]
+            except Exception as e:
+                logger.error(f"Error during API call for endpoint {endpoint_name}: {e}", exc_info=True)
+                await update.message.reply_text("抱歉，处理您的请求时出错。")
 
-                await update.message.reply_text(reply_text)
-            else:
-                logger.error(f"Invalid or empty response from API for endpoint {endpoint_name}: {response}")
-                await update.message.reply_text("抱歉，我从AI服务收到了意外的响应。")
-
-        except Exception as e:
-            logger.error(f"Error during API call for endpoint {endpoint_name}: {e}", exc_info=True)
-            await update.message.reply_text("抱歉，处理您的请求时出错。")
+            await conversation_store.set(user_id, session)
 
     return handler
 
@@ -181,71 +322,80 @@ async def text_message_handler(update: Update, context: ContextTypes.DEFAULT_TYP
     chat_id = update.effective_chat.id
 
     # 检查用户是否已授权
-    if not await is_user_authorized(user_id):
+    if not is_user_authorized(user_id):
         logger.warning(f"Unauthorized user {user_id} attempted to use the bot")
         await update.message.reply_text("抱歉，您没有权限使用此机器人。")
         return
 
-    # 检查用户是否有活跃的会话
-    if user_id not in user_conversations:
-        await update.message.reply_text("请先使用一个命令（如 /chat）来开始对话。")
-        return
+    async with get_user_lock(user_id):
+        # 检查用户是否有活跃的会话
+        session = await conversation_store.get(user_id)
+        if session is None:
+            await update.message.reply_text("请先使用一个命令（如 /chat）来开始对话。")
+            return
 
-    user_message = update.message.text
-    endpoint_name = user_conversations[user_id]["current_endpoint"]
-    model = user_conversations[user_id]["current_model"]
-    params = user_conversations[user_id]["current_params"]
+        user_message = update.message.text
+        endpoint_name = session["current_endpoint"]
+        payload_template = session["current_payload_template"]
+        messages = session["messages"]
 
-    try:
-        client = await get_openai_client(endpoint_name)
-    except ValueError as e:
-        logger.error(f"Failed to get OpenAI client: {e}")
-        await update.message.reply_text("抱歉，API连接配置出错。")
-        return
+        try:
+            client = get_openai_client(endpoint_name)
+        except ValueError as e:
+            logger.error(f"Failed to get OpenAI client: {e}")
+            await update.message.reply_text("抱歉，API连接配置出错。")
+            return
 
-    # 添加用户消息到会话历史
-    user_conversations[user_id]["messages"].append({"role": "user", "content": user_message})
+        # 添加用户消息到会话历史
+        messages.append({"role": "user", "content": user_message})
 
-    try:
-        # 显示输入指示器
-        await context.bot.send_chat_action(chat_id=chat_id, action='typing')
+        try:
+            # 显示输入指示器
+            await context.bot.send_chat_action(chat_id=chat_id, action='typing')
 
-        response = await client.create_chat_completion(
-            model=model,
-            messages=user_conversations[user_id]["messages"],
-            **params
-        )
+            reply_text = await generate_reply(update, client, endpoint_name, payload_template, list(messages))
+
+            if reply_text is not None:
+                # 添加助手回复到会话历史
+                messages.append({"role": "assistant", "content": reply_text})
+            else:
+                await update.message.reply_text("抱歉，我从AI服务收到了意外的响应。")
+
+        except Exception as e:
+            logger.error(f"Error during API call for endpoint {endpoint_name}: {e}", exc_info=True)
+            await update.message.reply_text("抱歉，处理您的请求时出错。")
 
-        if response and response.get("choices"):
-            assistant_message = response["choices"][0].get("message", {})
-            reply_text = assistant_message.get("content", "抱歉，我无法获取回复。")
+        await conversation_store.set(user_id, session)
 
-            # 添加助手回复到会话历史
-            user_conversations[user_id]["messages"].append({"role": "assistant", "content": reply_text})
+def _build_command_table(commands_config: Dict[str, CommandSpec]) -> List[Tuple[str, CommandSpec, Callable]]:
+    """
+    Normalize and validate command configurations once at startup.
 
-            # 限制会话历史的长度，防止过长
-            if len(user_conversations[user_id]["messages"]) > 20:  # 保留最近的20条消息
-                user_conversations[user_id]["messages"] = user_conversations[user_id]["messages"][-20:]
+    Args:
+        commands_config: Mapping of configured command names to their CommandSpec.
 
-            await update.message.reply_text(reply_text)
+    Returns:
+        A list of (command name without the leading '/', CommandSpec, handler callback) tuples.
+        Commands missing 'api_endpoint' or 'model' get config_error_handler as their callback.
+    """
+    command_table = []
+    for command_name, config in commands_config.items():
+        name = command_name.lstrip('/')
+        if config.endpoint and config.model:
+            callback = command_handler_factory(config)
         else:
-            logger.error(f"Invalid or empty response from API for endpoint {endpoint_name}: {response}")
-            await update.message.reply_text("抱歉，我从AI服务收到了意外的响应。")
-
-    except Exception as e:
-        logger.error(f"Error during API call for endpoint {endpoint_name}: {e}", exc_info=True)
-        await update.message.reply_text("抱歉，处理您的请求时出错。")
+            logger.error(f"Invalid command config for '{command_name}': {config}. Missing 'api_endpoint' or 'model'.")
+            callback = config_error_handler
+        command_table.append((name, config, callback))
+    return command_table
 
 async def post_init(application: Application):
     """
     Post-initialization tasks, like setting bot commands dynamically.
     """
-    commands_config = config_loader.get_all_commands()
-    bot_commands = []
-    for command_name, config in commands_config.items():
-        description = config.get("description", f"Trigger {command_name}")
-        # Command name in BotCommand should not have the leading '/'
-        bot_commands.append(BotCommand(command_name.lstrip('/'), description))
+    # Reuse the command table built when the application was created
+    command_table = application.bot_data.get("commands", [])
+    bot_commands = [BotCommand(name, config.description) for name, config, _ in command_table]
 
     if bot_commands:
         await application.bot.set_my_commands(bot_commands)
@@ -265,15 +415,17 @@ def create_bot_application() -> Application:
     application = Application.builder().token(telegram_token).post_init(post_init).build()
 
     # Dynamically register command handlers from config
-    commands_config = config_loader.get_all_commands()
-    if not commands_config:
+    command_table = _build_command_table(get_config_loader().get_command_specs())
+    application.bot_data["commands"] = command_table
+    # Command callbacks by lowercase name, used by route_text() to bypass the handler lookup
+    application.bot_data["command_callbacks"] = {}
+    if not command_table:
         logger.warning("No commands defined in the configuration file.")
     else:
-        for command_name, config in commands_config.items():
-            # Command name for handler registration should not have the leading '/'
-            handler = CommandHandler(command_name.lstrip('/'), command_handler_factory(config))
-            application.add_handler(handler)
-            logger.info(f"Registered handler for command: {command_name}")
+        for name, _, callback in command_table:
+            application.add_handler(CommandHandler(name, callback))
+            application.bot_data["command_callbacks"][name.lower()] = callback
+            logger.info(f"Registered handler for command: /{name}")
 
     # 添加文本消息处理器，实现连续对话功能
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, text_message_handler))
@@ -281,6 +433,41 @@ def create_bot_application() -> Application:
     logger.info("Telegram Bot Application created and handlers registered.")
     return application
 
+async def route_text(application: Application, update_data: Dict[str, Any]) -> bool:
+    """
+    Handle a plain text or command message directly from the raw update data.
+
+    This skips building the full Update object graph for the most common kind of update.
+    Anything else is left to the regular python-telegram-bot processing.
+
+    Args:
+        application: The initialized bot application
+        update_data: The decoded webhook payload
+
+    Returns:
+        True if the update was handled, False if it should go through Application.process_update
+    """
+    update = parse_text_update(update_data, application.bot)
+    if update is None:
+        return False
+
+    if update.command is None:
+        callback = text_message_handler
+    else:
+        name, _, username = update.command.partition('@')
+        # Commands addressed to another bot, or unknown commands, follow the regular path
+        if username and username != (application.bot.username or "").lower():
+            return False
+        callback = application.bot_data.get("command_callbacks", {}).get(name)
+        if callback is None:
+            return False
+
+    try:
+        await callback(update, FastContext(application.bot))
+    except Exception as e:
+        logger.error(f"Error handling update {update.update_id}: {e}", exc_info=True)
+    return True
+
 # Example of how to potentially run the bot (polling mode, not for FastAPI/webhook)
 # if __name__ == '__main__':
 #     app = create_bot_application()
@@ -2,14 +2,25 @@
 Configuration loader for managing YAML config files and environment variables.
 """
 import os
+import functools
 import yaml
-from typing import Dict, Any, Optional
+from collections import namedtuple
+from typing import Dict, Any, FrozenSet, Optional
 from pathlib import Path
 from dotenv import load_dotenv
 
+try:
+    # Prefer the libyaml-backed C loader when available
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
 # Load environment variables from .env file
 load_dotenv()
 
+# Immutable, pre-resolved view of a single command's configuration
+CommandSpec = namedtuple("CommandSpec", "endpoint model description payload_template")
+
 class ConfigLoader:
     """
     Handles loading and parsing configuration from YAML files and environment variables.
@@ -24,6 +35,8 @@ class ConfigLoader:
         """
         self.config_path = Path(config_path)
         self.config = self._load_config()
+        self._commands = self._build_command_specs()
+        self._authorized_users = frozenset(int(user_id) for user_id in self.config.get("authorized_users") or [])
 
     def _load_config(self) -> Dict[str, Any]:
         """
@@ -36,7 +49,7 @@ class ConfigLoader:
             return {}
 
         with open(self.config_path, 'r', encoding='utf-8') as file:
-            config = yaml.safe_load(file)
+            config = yaml.load(file, Loader=SafeLoader) or {}
 
         # Process environment variable references in config
         return self._process_env_vars(config)
@@ -62,6 +75,27 @@ class ConfigLoader:
         else:
             return config
 
+    def _build_command_specs(self) -> Dict[str, CommandSpec]:
+        """
+        Freeze the processed command configurations into CommandSpec tuples.
+
+        Returns:
+            Dictionary mapping command names to their CommandSpec
+        """
+        commands = self.config.get("commands") or {}
+        specs = {}
+        for command_name, command_config in commands.items():
+            model = command_config.get("model")
+            params = command_config.get("parameters") or {}
+            specs[command_name] = CommandSpec(
+                endpoint=command_config.get("api_endpoint"),
+                model=model,
+                description=command_config.get("description", f"Trigger {command_name}"),
+                # Request body without messages, merged once here instead of on every message
+                payload_template={"model": model, **params},
+            )
+        return specs
+
     def get_api_endpoint(self, endpoint_name: str) -> Optional[Dict[str, Any]]:
         """
         Get API endpoint configuration by name.
@@ -97,11 +131,31 @@ class ConfigLoader:
         """
         return self.config.get("commands", {})
 
-    def get_authorized_users(self) -> list:
+    def get_command_specs(self) -> Dict[str, CommandSpec]:
         """
-        获取授权用户ID列表。
+        Get all command configurations as pre-resolved CommandSpec tuples.
 
         Returns:
-            授权用户ID列表
+            Dictionary mapping command names to their CommandSpec
+        """
+        return self._commands
+
+    def get_authorized_users(self) -> FrozenSet[int]:
         """
-        return self.config.get("authorized_users", [])
+        获取授权用户ID集合。
+
+        Returns:
+            授权用户ID集合
+        """
+        return self._authorized_users
+
+
+@functools.cache
+def get_config_loader() -> ConfigLoader:
+    """
+    Get the process-wide ConfigLoader instance, creating it on first use.
+
+    Returns:
+        The shared ConfigLoader
+    """
+    return ConfigLoader()
@@ -1,10 +1,16 @@
 import os
+import atexit
+import hashlib
+import hmac
+import orjson
 import uvicorn
 import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
 from fastapi import FastAPI, Request, Response
 from telegram import Update
 from telegram.ext import Application
-from app.bot.main import create_bot_application, api_clients # Import necessary components
+from app.bot.main import create_bot_application, api_clients, conversation_store, route_text # Import necessary components
 from dotenv import load_dotenv
 
 # Load environment variables from .env file at the project root
@@ -17,6 +23,15 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Route log records through a queue so that handler I/O happens on a background thread
+# instead of blocking the event loop
+log_queue: queue.SimpleQueue = queue.SimpleQueue()
+root_logger = logging.getLogger()
+log_listener = QueueListener(log_queue, *root_logger.handlers, respect_handler_level=True)
+root_logger.handlers = [QueueHandler(log_queue)]
+log_listener.start()
+atexit.register(log_listener.stop)
+
 # --- Configuration ---
 TELEGRAM_BOT_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN")
 # Define a base URL for your webhook. Use environment variable or a default.
@@ -25,6 +40,11 @@ TELEGRAM_BOT_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN")
 WEBHOOK_BASE_URL = os.environ.get("WEBHOOK_BASE_URL", "http://localhost:8000") # Default for local testing
 WEBHOOK_PATH = f"/webhook/{TELEGRAM_BOT_TOKEN}" # Unique path per bot token
 WEBHOOK_URL = f"{WEBHOOK_BASE_URL.rstrip('/')}{WEBHOOK_PATH}"
+# Secret token Telegram sends back in the X-Telegram-Bot-Api-Secret-Token header.
+# Derived from the bot token when not set, so all workers agree on the same value.
+WEBHOOK_SECRET = os.environ.get("TELEGRAM_WEBHOOK_SECRET") or hashlib.sha256(f"webhook:{TELEGRAM_BOT_TOKEN}".encode()).hexdigest()
+# Maximum accepted webhook body size in bytes; Telegram updates are far smaller
+MAX_WEBHOOK_BODY_SIZE = 1_000_000
 
 # --- FastAPI App Initialization ---
 app = FastAPI()
@@ -47,7 +67,7 @@ async def startup_event():
 
         # Set the webhook
         logger.info(f"Setting webhook to: {WEBHOOK_URL}")
-        await ptb_app.bot.set_webhook(url=WEBHOOK_URL, allowed_updates=Update.ALL_TYPES)
+        await ptb_app.bot.set_webhook(url=WEBHOOK_URL, allowed_updates=Update.ALL_TYPES, secret_token=WEBHOOK_SECRET)
         logger.info("Webhook successfully set.")
 
     except Exception as e:
@@ -81,6 +101,12 @@ async def shutdown_event():
             logger.error(f"Error closing API client: {e}", exc_info=True)
     logger.info("API clients closed.")
 
+    try:
+        await conversation_store.close()
+        logger.info("Conversation store closed.")
+    except Exception as e:
+        logger.error(f"Error closing conversation store: {e}", exc_info=True)
+
 
 @app.post(WEBHOOK_PATH)
 async def telegram_webhook(request: Request):
@@ -91,8 +117,34 @@ async def telegram_webhook(request: Request):
         logger.error("Bot application not initialized.")
         return Response(status_code=500) # Internal Server Error
 
+    # Reject requests that did not come from Telegram before reading the body
+    secret = request.headers.get("x-telegram-bot-api-secret-token", "")
+    if not hmac.compare_digest(secret, WEBHOOK_SECRET):
+        logger.warning("Rejected webhook request with invalid secret token.")
+        return Response(status_code=403) # Forbidden
+
+    try:
+        content_length = int(request.headers.get("content-length", "0"))
+    except ValueError:
+        return Response(status_code=400) # Bad Request
+    if content_length > MAX_WEBHOOK_BODY_SIZE:
+        logger.warning(f"Rejected oversized webhook payload ({content_length} bytes).")
+        return Response(status_code=413) # Payload Too Large
+
+    # Read the body incrementally so chunked requests without Content-Length are bounded too
+    body = bytearray()
+    async for chunk in request.stream():
+        body += chunk
+        if len(body) > MAX_WEBHOOK_BODY_SIZE:
+            logger.warning("Rejected oversized webhook payload.")
+            return Response(status_code=413) # Payload Too Large
+
     try:
-        update_data = await request.json()
+        update_data = orjson.loads(body)
+        # Fast path for plain text messages; other update types use the full PTB processing
+        if await route_text(ptb_app, update_data):
+            return Response(status_code=200) # OK
+
         update = Update.de_json(data=update_data, bot=ptb_app.bot)
         logger.debug(f"Received update: {update}")
         await ptb_app.process_update(update)
@@ -117,4 +169,5 @@ if __name__ == "__main__":
         print(f"Starting FastAPI server on http://localhost:8000")
         print(f"Webhook URL configured (for setting): {WEBHOOK_URL}")
         print("Note: For local testing, you might need a tool like ngrok to expose localhost.")
+        # uvicorn picks uvloop and httptools automatically when they are installed
         uvicorn.run(app, host="0.0.0.0", port=7860)